@@ -3,11 +3,20 @@ import sys
 import time
 import subprocess
 import requests
-import json
 import shutil
 import threading
+import queue
+import re
+import asyncio
+import atexit
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import ollama
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import PatternMatchingEventHandler
 
 # --- (1) CONFIGURATION: EDIT THESE 4 PATHS ---
 # Folder 1: Where Syncthing saves audio files (The "Landing Zone")
@@ -16,11 +25,48 @@ WATCH_FOLDER = r"D:\Projects\Idea_sync" #<-- Your Syncthing target folder
 # Folder 2: Where the final .txt notes are saved (The "Google Drive Zone")
 FINAL_OUTPUT_FOLDER = r"D:\Projects\Formatted-Ideas" #<-- Your Google Drive folder
 
+# Stable audio is moved here before processing. It's a subfolder of WATCH_FOLDER,
+# but the observer isn't recursive, so nothing in here triggers any events.
+PROCESSING_FOLDER = os.path.join(WATCH_FOLDER, ".processing")
+# Leftover non-audio files are moved here on startup, to keep WATCH_FOLDER small
+ARCHIVE_FOLDER = os.path.join(WATCH_FOLDER, ".archive")
+
+# Remembers how far each file got, so work that was in flight when the
+# script stopped can be picked up again on the next start
+JOBS_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pipeline.db")
+
 # Tool Paths
-WHISPER_EXE = r"D:\Projects\Local_AI\Whisper\Whisper.exe"
+WHISPER_SERVER_EXE = r"D:\Projects\Local_AI\Whisper\whisper-server.exe"
 WHISPER_MODEL = r"D:\Projects\Local_AI\Whisper\ggml-base.en.bin"
+
+# Phone notifications
+NTFY_URL = "https://ntfy.sh/amit-g-idea-pipeline-rename-this" # <-- This is your topic
 # ----------------------------------------------------
 
+# whisper-server is started once and keeps the model loaded between files
+WHISPER_SERVER_HOST = "127.0.0.1"
+WHISPER_SERVER_PORT = 8089
+WHISPER_SERVER_URL = f"http://{WHISPER_SERVER_HOST}:{WHISPER_SERVER_PORT}"
+# Leave one core free for Syncthing, the watcher and the rest of the pipeline,
+# and never go above whisper-server's own default of 4 threads
+WHISPER_THREADS = min(4, max(1, (os.cpu_count() or 2) - 1))
+
+OLLAMA_HOST = "http://localhost:11434"
+OLLAMA_MODEL = "mistral:7b" # Use any model available in your local Ollama
+# A new file triggers a model warm-up, but no more often than this
+OLLAMA_WARM_UP_INTERVAL_SECONDS = 60
+
+# A file counts as "stable" once no write event has arrived for this many seconds
+QUIESCENCE_SECONDS = 3
+# Fallback rescan of WATCH_FOLDER, in case a network drive drops events
+RESCAN_INTERVAL_SECONDS = 30
+# A locked file is retried with growing delays (1s, 2s, 4s ... up to 30s), then given up on
+LOCKED_FILE_MAX_RETRIES = 8
+LOCKED_FILE_MAX_DELAY_SECONDS = 30.0
+# Transcriptions that finish within this window are formatted in one Ollama request
+BATCH_WINDOW_SECONDS = 3
+BATCH_MAX_SIZE = 8
+
 # This is the prompt we will send to the local AI
 FORMATTING_PROMPT = """
 The following is a raw, transcribed voice memo. Please take these ideas
@@ -33,183 +79,643 @@ Here is the transcription:
 ---
 """
 
+# Used when several memos are formatted together in one request
+BATCH_FORMATTING_PROMPT = """
+The following are {count} raw, transcribed voice memos. Each memo starts
+with its number in square brackets, like [1]. For each memo, please take
+its ideas and neatly document them as a clean, concise bulleted list.
+If a memo has no clear ideas, just summarize its text.
+
+Answer every memo separately and never mix ideas between memos.
+Start each answer on its own line with the same number in square brackets
+as its memo, like [1], and write nothing before the first answer.
+
+Here are the transcriptions:
+---
+{transcribed_texts}
+---
+"""
+
+# Matches the "[1]" markers that separate the answers in a batched response
+BATCH_MARKER = re.compile(r"^\s*\[(\d+)\]", re.MULTILINE)
+
+# The pipeline runs in three stages, each with its own worker thread, so different
+# files can be transcribed (CPU), formatted (GPU) and saved/notified (network) at once.
+# The queues are bounded, so a slow stage holds back the ones before it.
+# Stable files waiting for Whisper: processing_path
+q_transcribe = queue.Queue(maxsize=4)
+# Transcriptions waiting for Ollama: (processing_path, raw_text)
+q_format = queue.Queue(maxsize=4)
+# Formatted notes waiting to be saved: (processing_path, formatted_note)
+q_notify = queue.Queue(maxsize=4)
+
+# One HTTP session for the whole script, so connections (and the TLS
+# handshake with ntfy.sh) are reused. Transient 5xx errors are retried, and so are
+# failed connects (the request never got sent). Read errors and timeouts are not:
+# the server may already have acted on the POST, or be busy with a long transcription.
+SESSION = requests.Session()
+SESSION.headers["Connection"] = "keep-alive"
+_retries = Retry(total=3, connect=3, read=0, other=0, status=3, backoff_factor=0.5,
+                 status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset({"POST"}))
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=_retries))
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=_retries))
+
+# Notifications are sent in the background so they don't hold up the next file.
+# Pending ones are still flushed when the script exits.
+NTFY_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ntfy")
+atexit.register(NTFY_POOL.shutdown, wait=True)
+
+# One Ollama client for the whole script, so its connections get reused.
+# All Ollama calls run on ollama_loop, which lives in a background thread.
+ollama_client = ollama.AsyncClient(host=OLLAMA_HOST)
+ollama_loop = asyncio.new_event_loop()
+# What a failed Ollama call can raise: HTTP errors from Ollama itself, refused
+# connections, and the httpx errors the client passes through (timeouts, dropped connections)
+OLLAMA_ERRORS = (ollama.ResponseError, ConnectionError, httpx.HTTPError)
+# When we last asked Ollama to load the model
+last_warm_up = 0.0
+
+# Job states, in order: pending -> stable -> transcribed -> formatted -> done.
+# A job is keyed by the file's current path: its WATCH_FOLDER path while 'pending',
+# then its PROCESSING_FOLDER path (which may have been renamed to be unique).
+# The connection is shared by all threads, so every use goes through jobs_lock.
+jobs_db = sqlite3.connect(JOBS_DB, check_same_thread=False)
+jobs_db.execute("PRAGMA journal_mode=WAL")
+jobs_db.execute("CREATE TABLE IF NOT EXISTS jobs(path TEXT PRIMARY KEY, state TEXT, updated REAL)")
+jobs_db.commit()
+jobs_lock = threading.Lock()
+
+# Held while picking a free name in PROCESSING_FOLDER and moving a file there
+processing_names_lock = threading.Lock()
+
+# --- Job Tracking ---
+# Job tracking only helps recovery, so a database error (e.g. "database is locked"
+# while pipeline.db is open elsewhere) is logged and never stops the pipeline.
+
+def run_job_query(sql, params):
+    """
+    Runs one statement against the jobs table. Returns the first row, or None
+    if there is no row or the database failed.
+    """
+    with jobs_lock:
+        try:
+            row = jobs_db.execute(sql, params).fetchone()
+            jobs_db.commit()
+            return row
+        except sqlite3.Error as e:
+            print(f"[Sentry] Warning: Job tracking failed ({e}). Carrying on without it.")
+            try:
+                jobs_db.rollback()
+            except sqlite3.Error:
+                pass
+            return None
+
+def add_job(path):
+    """
+    Records a newly detected file as 'pending'. Anything in WATCH_FOLDER is new,
+    so this also resets the row left behind by an older file with the same name.
+    """
+    set_job_state(path, "pending")
+
+def set_job_state(path, state):
+    """
+    Moves a file's job to the given state.
+    """
+    run_job_query("INSERT OR REPLACE INTO jobs(path, state, updated) VALUES (?, ?, ?)", (path, state, time.time()))
+
+def forget_job(path):
+    """
+    Removes a file's job row (used once the file has moved and has a new row).
+    """
+    run_job_query("DELETE FROM jobs WHERE path = ?", (path,))
+
+def get_job_state(path):
+    """
+    Returns a file's job state, or None if we have never seen it (or can't tell).
+    """
+    row = run_job_query("SELECT state FROM jobs WHERE path = ?", (path,))
+    return row[0] if row else None
+
 # --- Helper Functions (Transcribe & Format) ---
 
-def format_text(text_to_format):
+async def ollama_generate(prompt):
+    """
+    Sends a prompt to the local Ollama model and returns its response text.
+    """
+    response = await ollama_client.generate(model=OLLAMA_MODEL, prompt=prompt)
+    return response["response"]
+
+async def warm_up_ollama_async():
+    """
+    Asks Ollama to load the model without generating anything.
+    """
+    try:
+        # An empty prompt only loads the model into memory
+        await ollama_client.generate(model=OLLAMA_MODEL, prompt="")
+        print("[Processor] Ollama model is loaded.")
+    except OLLAMA_ERRORS as e:
+        # Nobody waits on this call's result, so anything not caught here would vanish silently
+        print(f"[Processor] Warning: Could not warm up Ollama: {e}")
+
+def warm_up_ollama():
+    """
+    Loads the Ollama model in the background, so the first note doesn't wait for it.
+    Does nothing if we already did this in the last OLLAMA_WARM_UP_INTERVAL_SECONDS.
+    """
+    global last_warm_up
+    now = time.monotonic()
+    if now - last_warm_up < OLLAMA_WARM_UP_INTERVAL_SECONDS:
+        return
+    last_warm_up = now
+    asyncio.run_coroutine_threadsafe(warm_up_ollama_async(), ollama_loop)
+
+async def format_text_async(text_to_format):
     """
     Sends raw text to a local Ollama model for formatting.
     """
     print(f"[Processor] Sending to Ollama for formatting...")
-    url = "http://localhost:11434/api/generate"
-    payload = {
-        "model": "mistral:7b", # Use any model available in your local Ollama
-        "prompt": FORMATTING_PROMPT.format(transcribed_text=text_to_format),
-        "stream": False
-    }
     try:
-        # Post the request to the local Ollama server
-        response = requests.post(url, data=json.dumps(payload))
-        response.raise_for_status() # Raise an error for bad status codes
-        response_data = response.json()
-        formatted_text = response_data.get("response", "Error: No response from Ollama")
+        formatted_text = await ollama_generate(FORMATTING_PROMPT.format(transcribed_text=text_to_format))
         print("[Processor] Got formatted text.")
         return formatted_text
-    except requests.exceptions.RequestException as e:
+    except OLLAMA_ERRORS as e:
         print(f"[Processor] ERROR connecting to Ollama: {e}")
-        print("    Is Ollama running? Did you run 'ollama pull mistral:7b'?")
+        print(f"    Is Ollama running? Did you run 'ollama pull {OLLAMA_MODEL}'?")
         return f"Error: Could not connect to Ollama. Raw text: {text_to_format}"
 
+def split_batch_response(response_text, count):
+    """
+    Splits a batched Ollama response back into one note per memo.
+    Returns None if the answers can't be matched up with the memos.
+    """
+    markers = list(BATCH_MARKER.finditer(response_text))
+    if len(markers) != count:
+        return None
+    notes = {}
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(response_text)
+        notes[int(marker.group(1))] = response_text[marker.end():end].strip()
+    if sorted(notes) != list(range(1, count + 1)) or not all(notes.values()):
+        return None
+    return [notes[i] for i in range(1, count + 1)]
+
+async def format_batch_async(texts):
+    """
+    Formats several transcriptions with a single Ollama request.
+    Returns None if the request fails or the response can't be split up.
+    """
+    print(f"[Processor] Sending {len(texts)} transcriptions to Ollama in one batch...")
+    numbered_texts = "\n\n".join(f"[{i}] {text.strip()}" for i, text in enumerate(texts, 1))
+    prompt = BATCH_FORMATTING_PROMPT.format(count=len(texts), transcribed_texts=numbered_texts)
+    try:
+        notes = split_batch_response(await ollama_generate(prompt), len(texts))
+    except OLLAMA_ERRORS as e:
+        print(f"[Processor] ERROR connecting to Ollama: {e}")
+        return None
+    if notes is None:
+        print("[Processor] Could not split the batched response. Formatting files one by one...")
+    else:
+        print("[Processor] Got formatted text for the whole batch.")
+    return notes
+
+async def format_texts_async(texts):
+    """
+    Formats a group of transcriptions, in one batched request where possible.
+    Returns one result per text: the note, or the exception that formatting it raised.
+    """
+    if len(texts) > 1:
+        notes = await format_batch_async(texts)
+        if notes is not None:
+            return notes
+    # Single file, or the batch failed: send one request per file, all at once.
+    # Ollama overlaps them up to OLLAMA_NUM_PARALLEL.
+    # One failing request must not take the other files down with it.
+    return list(await asyncio.gather(*(format_text_async(text) for text in texts), return_exceptions=True))
+
+def unique_processing_path(file_name):
+    """
+    Returns a free path for file_name in PROCESSING_FOLDER, adding " (1)", " (2)" ...
+    if needed. Phones can reuse a name (e.g. "Voice 001.m4a") while the first
+    file with that name is still queued.
+    """
+    stem, ext = os.path.splitext(file_name)
+    processing_path = os.path.join(PROCESSING_FOLDER, file_name)
+    n = 1
+    while os.path.exists(processing_path):
+        processing_path = os.path.join(PROCESSING_FOLDER, f"{stem} ({n}){ext}")
+        n += 1
+    return processing_path
+
+def remove_audio(processing_path):
+    """
+    Deletes an audio file from PROCESSING_FOLDER once we are done with it.
+    """
+    try:
+        os.remove(processing_path)
+        print(f"[Processor] Cleaned up original audio file.")
+    except Exception as e:
+        print(f"[Processor] Warning: Could not delete original audio file: {e}")
+
+def send_notification(message):
+    """
+    Sends a push notification to the phone through ntfy.
+    """
+    try:
+        SESSION.post(NTFY_URL, data=message.encode(), timeout=(5, 30))
+        print("[Processor] Sent notification to phone.")
+    except Exception as e:
+        print(f"[Processor] Warning: Could not send ntfy notification: {e}")
+
+def finish_note(processing_path, formatted_note):
+    """
+    Saves a formatted note, notifies the phone and removes the audio file.
+    """
+    # 3. Save the final .txt note
+    stem, _ = os.path.splitext(os.path.basename(processing_path))
+    final_filename = stem + ".txt"
+    final_path = os.path.join(FINAL_OUTPUT_FOLDER, final_filename)
+    with open(final_path, 'w', encoding='utf-8') as f:
+        f.write(formatted_note)
+    print(f"[Processor] SUCCESS! Saved final note to {final_path}")
+    
+    # 4. Send ntfy notification to the phone (in the background)
+    NTFY_POOL.submit(send_notification, f"New idea captured: {final_filename}")
+    
+    # 5. Clean up original audio file from PROCESSING_FOLDER
+    remove_audio(processing_path)
+    set_job_state(processing_path, "done")
+
+def transcribe_worker():
+    """
+    Stage 1: Transcribes stable files one at a time and passes the text on to q_format.
+    """
+    while True:
+        processing_path = q_transcribe.get()
+        try:
+            raw_text = transcribe_audio(processing_path)
+            
+            if raw_text:
+                set_job_state(processing_path, "transcribed")
+                q_format.put((processing_path, raw_text))
+            else:
+                remove_audio(processing_path)
+                set_job_state(processing_path, "done")
+        except Exception as e:
+            print(f"[Processor] !!! UNHANDLED ERROR processing {processing_path}: {e}")
+
+def format_worker():
+    """
+    Stage 2: Collects transcriptions that finish close together, formats them
+    as one batch and passes the notes on to q_notify.
+    """
+    while True:
+        # Block until there is work, then keep collecting until the window closes
+        batch = [q_format.get()]
+        while len(batch) < BATCH_MAX_SIZE:
+            try:
+                batch.append(q_format.get(timeout=BATCH_WINDOW_SECONDS))
+            except queue.Empty:
+                break
+
+        texts = [raw_text for _, raw_text in batch]
+        try:
+            notes = asyncio.run_coroutine_threadsafe(format_texts_async(texts), ollama_loop).result()
+        except Exception as e:
+            notes = [e] * len(batch)
+        for (processing_path, raw_text), note in zip(batch, notes):
+            if isinstance(note, BaseException):
+                # Still save a note, so the raw transcription isn't lost
+                print(f"[Processor] !!! UNHANDLED ERROR formatting {processing_path}: {note}")
+                note = f"Error: Could not format this note ({note}). Raw text: {raw_text}"
+            set_job_state(processing_path, "formatted")
+            q_notify.put((processing_path, note))
+
+def notify_worker():
+    """
+    Stage 3: Saves each formatted note, notifies the phone and removes the audio.
+    """
+    while True:
+        processing_path, note = q_notify.get()
+        try:
+            finish_note(processing_path, note)
+        except Exception as e:
+            print(f"[Processor] !!! UNHANDLED ERROR processing {processing_path}: {e}")
+
+def recover_jobs(handler):
+    """
+    Picks up the files that were left unfinished when the script last stopped.
+    """
+    # Files in PROCESSING_FOLDER were already stable. Transcribe them again,
+    # since the text was only ever held in memory.
+    for file_name in os.listdir(PROCESSING_FOLDER):
+        processing_path = os.path.join(PROCESSING_FOLDER, file_name)
+        if os.path.isfile(processing_path) and get_job_state(processing_path) != "done":
+            print(f"[Sentry] Resuming unfinished file: {file_name}")
+            q_transcribe.put(processing_path)
+    # Files still in WATCH_FOLDER were never processed (processing moves them out),
+    # and the observer won't report files that already exist
+    handler.rescan()
+
+def start_whisper_server():
+    """
+    Starts whisper-server and waits until it has loaded the model.
+    Returns the server process, or None if it failed to start.
+    """
+    print("[Processor] Starting Whisper server...")
+    # --convert lets the server decode .m4a/.ogg/.aac (it needs ffmpeg on the PATH).
+    command = [WHISPER_SERVER_EXE, "-m", WHISPER_MODEL, "--host", WHISPER_SERVER_HOST, "--port", str(WHISPER_SERVER_PORT), "--convert", "-t", str(WHISPER_THREADS)]
+    # CREATE_NO_WINDOW hides the annoying command prompt pop-up.
+    # BELOW_NORMAL_PRIORITY_CLASS lets Syncthing and the watcher run first when the CPU is busy.
+    creationflags = subprocess.CREATE_NO_WINDOW | subprocess.BELOW_NORMAL_PRIORITY_CLASS
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, creationflags=creationflags)
+    # However the script ends, don't leave the server running and holding the port
+    atexit.register(process.terminate)
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            print(f"[Processor] ERROR: Whisper server exited with code {process.returncode}.")
+            return None
+        try:
+            # While the model is still loading the server may not answer, or answer with an error.
+            # Plain requests.get, not SESSION: its connect retries would stretch every probe.
+            if requests.get(WHISPER_SERVER_URL, timeout=1).ok:
+                print("[Processor] Whisper server is ready.")
+                return process
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.5)
+    print("[Processor] Warning: Whisper server is not answering yet. Continuing anyway.")
+    return process
+
 def transcribe_audio(audio_file_path):
     """
-    Uses Whisper.exe to transcribe a given audio file.
+    Sends an audio file to the running whisper-server for transcription.
     """
     print(f"[Processor] Transcribing {audio_file_path}...")
-    # Whisper.exe creates a .txt file with the same name as the audio file
-    output_txt_file = os.path.splitext(audio_file_path)[0] + ".txt"
-    command = [WHISPER_EXE, "-m", WHISPER_MODEL, "-f", audio_file_path, "-otxt"]
-    
     try:
-        # Run the Whisper command-line tool.
-        # CREATE_NO_WINDOW hides the annoying command prompt pop-up.
-        subprocess.run(command, check=True, capture_output=True, text=True, creationflags=subprocess.CREATE_NO_WINDOW)
+        with open(audio_file_path, "rb") as f:
+            response = SESSION.post(
+                f"{WHISPER_SERVER_URL}/inference",
+                files={"file": f},
+                data={"response_format": "text"},
+                timeout=(5, 600)
+            )
+        response.raise_for_status() # Raise an error for bad status codes
         
-        # If the output file was created...
-        if os.path.exists(output_txt_file):
-            # Read the text from it
-            with open(output_txt_file, 'r', encoding='utf-8') as f:
-                transcribed_text = f.read()
+        transcribed_text = response.text.strip()
+        if transcribed_text:
             print("[Processor] Transcription complete.")
-            # Clean up the .txt file that Whisper made
-            os.remove(output_txt_file) 
             return transcribed_text
         else:
-            print("[Processor] ERROR: Whisper ran but output .txt file was not found.")
+            print("[Processor] ERROR: Whisper returned no transcription.")
             return None
-    except subprocess.CalledProcessError as e:
-        print(f"[Processor] ERROR running Whisper: {e.stderr}")
+    except requests.exceptions.RequestException as e:
+        print(f"[Processor] ERROR from the Whisper server: {e}")
+        print("    Is whisper-server running? Check WHISPER_SERVER_EXE and WHISPER_MODEL.")
         return None
 
 # --- Main Watcher: The "Sentry" ---
 # This class watches the WATCH_FOLDER (Inbox).
-# It checks for file stability and then processes the file.
+# Every write event re-arms a per-file timer; once the file has been quiet
+# for QUIESCENCE_SECONDS it is considered stable and gets processed.
+
+AUDIO_EXTENSIONS = frozenset({'.mp3', '.m4a', '.wav', '.ogg', '.aac'})
 
-class SentryHandler(FileSystemEventHandler):
+def archive_leftovers():
+    """
+    Moves leftover non-audio files (old .txt notes and the like) out of WATCH_FOLDER.
+    Every file in the folder adds to the events the observer has to sort through.
+    """
+    moved = 0
+    for file_name in os.listdir(WATCH_FOLDER):
+        file_path = os.path.join(WATCH_FOLDER, file_name)
+        # Leave audio, folders and Syncthing's own files (.stignore, temp files) alone
+        if (not os.path.isfile(file_path) or file_name.startswith(('.', '~'))
+                or os.path.splitext(file_name)[1].lower() in AUDIO_EXTENSIONS):
+            continue
+        try:
+            os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+            shutil.move(file_path, os.path.join(ARCHIVE_FOLDER, file_name))
+            moved += 1
+        except OSError as e:
+            print(f"[Sentry] Warning: Could not archive {file_name}: {e}")
+    if moved:
+        print(f"[Sentry] Moved {moved} leftover file(s) to {ARCHIVE_FOLDER}")
+
+class SentryHandler(PatternMatchingEventHandler):
     def __init__(self):
-        # Avoid checking the same file multiple times from different events
-        self.files_being_checked = set() 
+        # Let watchdog drop events for directories, non-audio files and
+        # Syncthing/Whisper temp files before they reach our callbacks
+        super().__init__(
+            patterns=["*" + ext for ext in sorted(AUDIO_EXTENSIONS)],
+            ignore_patterns=["*.tmp", "*.syncthing.*", "*.txt", ".*", "~*"],
+            ignore_directories=True
+        )
+        # Files we are waiting on or processing, so they aren't picked up twice
+        self.files_being_checked = set()
+        # Monotonic time of the last write event we saw for each file
+        self.last_event = {}
+        # The pending quiescence timer for each file
+        self.timers = {}
+        # Size and mtime of each file when its timer was (re)started
+        self.last_stat = {}
+        # Guards the collections above. They are used from the observer thread,
+        # the timer threads and the rescan thread.
+        self._lock = threading.Lock()
 
     def on_created(self, event):
         """
         Called when a file is first created (e.g., Syncthing starts writing).
         """
-        if event.is_directory:
-            return
         self.start_stability_check(event.src_path)
 
     def on_modified(self, event):
         """
         Called as Syncthing writes data chunks to the file.
         """
-        if event.is_directory:
-            return
         # We start the check on 'modified' as well, in case 'created' was missed.
         self.start_stability_check(event.src_path)
 
+    def on_moved(self, event):
+        """
+        Called when a file is renamed. Syncthing writes to a temp file and
+        renames it to the real name once the transfer is done.
+        """
+        # The event also gets here if only the old name matched our patterns
+        file_name = os.path.basename(event.dest_path)
+        if file_name.startswith(('.', '~')) or os.path.splitext(file_name)[1].lower() not in AUDIO_EXTENSIONS:
+            return
+        self.start_stability_check(event.dest_path)
+
     def start_stability_check(self, file_path):
         """
-        Starts a stability check thread, but only if it's an audio file
-        and we aren't already checking it.
+        Records a write to an audio file and (re)starts its quiescence timer.
+        """
+        signature = self._file_signature(file_path)
+        is_new = False
+        # Check-then-add must be atomic, or two events could both start a check
+        with self._lock:
+            # Already stable and being processed: ignore further events
+            if file_path in self.files_being_checked and file_path not in self.timers:
+                return
+            if file_path not in self.files_being_checked:
+                self.files_being_checked.add(file_path)
+                is_new = True
+
+            self.last_event[file_path] = time.monotonic()
+            self.last_stat[file_path] = signature
+            # Every new write pushes the deadline back
+            self._schedule(file_path, QUIESCENCE_SECONDS)
+
+        # Outside the lock: these don't touch our collections and may be slow
+        if is_new:
+            print(f"[Sentry] New file detected: {os.path.basename(file_path)}. Waiting for transfer to complete...")
+            add_job(file_path)
+            # Have the model ready by the time Whisper is done with this file
+            warm_up_ollama()
+
+    def _file_signature(self, file_path):
+        """
+        Returns a file's (size, mtime), or None if it can't be read right now.
+        """
+        try:
+            stat_result = os.stat(file_path)
+        except OSError:
+            return None
+        return (stat_result.st_size, stat_result.st_mtime_ns)
+
+    def _schedule(self, file_path, delay):
+        """
+        (Re)starts a file's quiescence timer. Must be called with self._lock held.
+        """
+        old_timer = self.timers.get(file_path)
+        if old_timer is not None:
+            old_timer.cancel()
+        timer = threading.Timer(delay, self._fire)
+        # The timer passes itself along, so _fire can tell if it has been replaced
+        timer.args = (file_path, timer)
+        timer.daemon = True
+        self.timers[file_path] = timer
+        timer.start()
+
+    def _fire(self, file_path, timer):
+        """
+        Runs when a file's timer expires. Processes it if it has been quiet long enough.
+        """
+        with self._lock:
+            # A newer event replaced this timer just as it fired; that timer will handle it
+            if self.timers.get(file_path) is not timer:
+                return
+            remaining = QUIESCENCE_SECONDS - (time.monotonic() - self.last_event.get(file_path, 0))
+            if remaining > 0:
+                # Fired a little early (the clock is coarse on Windows): wait out the rest
+                self._schedule(file_path, remaining)
+                return
+            # No event arrived, but the file may still be growing if events are
+            # being missed (the case the rescan is for): then wait another full period
+            signature = self._file_signature(file_path)
+            if signature != self.last_stat.get(file_path):
+                self.last_stat[file_path] = signature
+                self.last_event[file_path] = time.monotonic()
+                self._schedule(file_path, QUIESCENCE_SECONDS)
+                return
+            self.timers.pop(file_path, None)
+        self.check_and_process_thread(file_path)
+
+    def _release(self, file_path):
+        """
+        Forgets a file, so a new event for the same path starts a fresh check.
+        """
+        with self._lock:
+            self.files_being_checked.discard(file_path)
+            self.last_event.pop(file_path, None)
+            self.last_stat.pop(file_path, None)
+
+    def rescan(self):
+        """
+        Looks for audio files in WATCH_FOLDER that we have no event for.
         """
-        # Check if it's an audio file and not already in our check-list
-        if file_path not in self.files_being_checked and file_path.endswith(('.mp3', '.m4a', '.wav', '.ogg', '.aac')):
-            self.files_being_checked.add(file_path)
-            print(f"[Sentry] New file detected: {os.path.basename(file_path)}. Starting stability check...")
-            # Run the check and processing in a separate thread
-            t = threading.Thread(target=self.check_and_process_thread, args=(file_path,))
-            t.start()
+        try:
+            file_names = os.listdir(WATCH_FOLDER)
+        except OSError as e:
+            print(f"[Sentry] Warning: Could not rescan {WATCH_FOLDER}: {e}")
+            return
+        for file_name in file_names:
+            # Same filter the observer applies through our patterns
+            if file_name.startswith(('.', '~')) or os.path.splitext(file_name)[1].lower() not in AUDIO_EXTENSIONS:
+                continue
+            file_path = os.path.join(WATCH_FOLDER, file_name)
+            if file_path not in self.files_being_checked and os.path.isfile(file_path):
+                self.start_stability_check(file_path)
+
+    def rescan_loop(self):
+        """
+        Rescans WATCH_FOLDER every RESCAN_INTERVAL_SECONDS, in case events were missed.
+        """
+        while True:
+            time.sleep(RESCAN_INTERVAL_SECONDS)
+            self.rescan()
 
     def check_and_process_thread(self, file_path):
         """
-        Polls the file size until it stops changing, then processes it.
+        Moves a stable file into PROCESSING_FOLDER and queues it for transcription.
+        Runs in the file's timer thread once its quiescence timer has expired.
         """
-        last_size = -1
-        stable_count = 0
-        max_stable_count = 3 # ~15 seconds of stability (3 checks * 5s)
-        
-        print(f"[Sentry] Waiting for file transfer to complete...")
-        while stable_count < max_stable_count:
+        file_name = os.path.basename(file_path)
+        delay = 1.0
+        attempts = 0
+        while True:
             try:
-                # Check if file still exists (it might have been moved/deleted)
-                if not os.path.exists(file_path):
-                    print(f"[Sentry] File {os.path.basename(file_path)} disappeared. Stopping check.")
-                    self.files_being_checked.remove(file_path)
+                # One stat call gives us both "does it exist" and its size
+                current_size = os.stat(file_path).st_size
+                if current_size == 0:
+                    # Placeholder only. The next write event (or rescan) will pick it up again.
+                    print("    ... file is 0 bytes (placeholder). Waiting for data.")
+                    self._release(file_path)
                     return
-                    
-                # Get the current file size
-                current_size = os.path.getsize(file_path)
+
+                # Move the file out of WATCH_FOLDER before working on it,
+                # so nothing we do to it wakes the observer again.
+                # PROCESSING_FOLDER is on the same drive, so this is a plain rename:
+                # it either moves the whole file or fails (e.g. still locked) and
+                # changes nothing. shutil.move would fall back to copy + delete
+                # and could leave a partial copy behind.
+                # Never overwrite a file that is still queued: pick a free name.
+                with processing_names_lock:
+                    processing_path = unique_processing_path(file_name)
+                    # Recorded before the move, so a crash right after it can't leave
+                    # the file behind an old 'done' row for the same name
+                    set_job_state(processing_path, "stable")
+                    os.replace(file_path, processing_path)
+                break
+            except FileNotFoundError:
+                # It was moved or deleted while we waited
+                print(f"[Sentry] File {file_name} disappeared. Stopping check.")
+                self._release(file_path)
+                return
             except OSError as e:
                 # File is locked by another process (like Syncthing). Wait and retry.
-                print(f"    ... file is locked (Error: {e}). Retrying in 5s.")
-                time.sleep(5) 
-                continue
+                attempts += 1
+                if attempts > LOCKED_FILE_MAX_RETRIES:
+                    # Free the slot; the next write event or rescan will try again
+                    print(f"[Sentry] Giving up on {file_name}: still locked after {LOCKED_FILE_MAX_RETRIES} retries.")
+                    self._release(file_path)
+                    return
+                print(f"    ... file is locked (Error: {e}). Retrying in {delay:.0f}s.")
+                time.sleep(delay)
+                delay = min(delay * 2, LOCKED_FILE_MAX_DELAY_SECONDS)
 
-            # If size is the same as last check, and not 0 bytes...
-            if current_size == last_size and current_size > 0:
-                stable_count += 1
-                print(f"[Sentry] ... file is stable. Check {stable_count}/{max_stable_count}.")
-            else:
-                # Size changed, or is 0. Reset the stability counter.
-                stable_count = 0
-                if current_size == 0:
-                    print("    ... file is 0 bytes (placeholder). Waiting for data.")
-                else:
-                    print(f"    ... file is still growing (now {current_size} bytes).")
-            
-            last_size = current_size
-            time.sleep(5) # Wait 5 seconds between checks
+        # The file has left WATCH_FOLDER, so events and rescans can't pick it up twice
+        self._release(file_path)
+        # Its job now lives on under processing_path
+        forget_job(file_path)
 
-        # --- File is Stable: Begin Processing ---
-        print(f"[Sentry] STABLE. File '{os.path.basename(file_path)}' is ready. Processing...")
-        try:
-            file_name = os.path.basename(file_path)
-            
-            # 1. Transcribe
-            raw_text = transcribe_audio(file_path)
-            
-            if raw_text:
-                # 2. Format
-                formatted_note = format_text(raw_text)
-                
-                # 3. Save the final .txt note
-                final_filename = os.path.splitext(file_name)[0] + ".txt"
-                final_path = os.path.join(FINAL_OUTPUT_FOLDER, final_filename)
-                with open(final_path, 'w', encoding='utf-8') as f:
-                    f.write(formatted_note)
-                print(f"[Processor] SUCCESS! Saved final note to {final_path}")
-                
-                # 4. Send ntfy notification to the phone
-                try:
-                    requests.post(
-                        "https://ntfy.sh/amit-g-idea-pipeline-rename-this", # <-- This is your topic
-                        data=f"New idea captured: {final_filename}".encode(encoding='utf-8')
-                    )
-                    print("[Processor] Sent notification to phone.")
-                except Exception as e:
-                    print(f"[Processor] Warning: Could not send ntfy notification: {e}")
-            
-            # 5. Clean up original audio file from WATCH_FOLDER
-            try:
-                os.remove(file_path)
-                print(f"[Processor] Cleaned up original audio file.")
-            except Exception as e:
-                print(f"[Processor] Warning: Could not delete original audio file: {e}")
-
-        except Exception as e:
-            print(f"[Processor] !!! UNHANDLED ERROR processing {file_path}: {e}")
-        finally:
-            # Clean up: remove the file from the set of files being checked
-            if file_path in self.files_being_checked:
-                self.files_being_checked.remove(file_path)
+        # --- File is Stable: Hand it to the pipeline ---
+        if os.path.basename(processing_path) != file_name:
+            print(f"[Sentry] A file named '{file_name}' is still queued. Processing this one as '{os.path.basename(processing_path)}'.")
+        print(f"[Sentry] STABLE. File '{file_name}' is ready. Processing...")
+        q_transcribe.put(processing_path)
 
 
 # --- Main script execution ---
@@ -222,7 +728,24 @@ if __name__ == "__main__":
         print(f"ERROR: FINAL_OUTPUT_FOLDER does not exist: {FINAL_OUTPUT_FOLDER}")
         sys.exit(1)
 
+    # Holds audio files while they are being transcribed and formatted
+    os.makedirs(PROCESSING_FOLDER, exist_ok=True)
+    # Start with a WATCH_FOLDER that only holds audio
+    archive_leftovers()
+
     print("--- Single-Folder Idea Processor ---")
+
+    # Runs the async Ollama calls
+    threading.Thread(target=ollama_loop.run_forever, daemon=True).start()
+    # Load the Ollama model while everything else starts up
+    warm_up_ollama()
+    if "OLLAMA_KEEP_ALIVE" not in os.environ:
+        print("Tip: Ollama unloads the model after 5 idle minutes. Set OLLAMA_KEEP_ALIVE=24h for the Ollama server to keep it loaded.", file=sys.stderr)
+
+    # Load the Whisper model once for the whole session
+    whisper_server = start_whisper_server()
+    if whisper_server is None:
+        sys.exit(1)
     
     # Setup the Sentry Watcher
     event_handler_sentry = SentryHandler()
@@ -231,16 +754,28 @@ if __name__ == "__main__":
     
     # Start the watcher
     observer_sentry.start()
+    # One worker per pipeline stage: transcribe -> format -> save & notify
+    threading.Thread(target=transcribe_worker, daemon=True).start()
+    threading.Thread(target=format_worker, daemon=True).start()
+    threading.Thread(target=notify_worker, daemon=True).start()
+    # Pick up anything left over from the last run (in the background,
+    # since the bounded queues may make this wait)
+    threading.Thread(target=recover_jobs, args=(event_handler_sentry,), daemon=True).start()
+    # Safety net for events the observer might miss
+    threading.Thread(target=event_handler_sentry.rescan_loop, daemon=True).start()
     
     print(f"SENTRY watching: {WATCH_FOLDER}")
     print("Press CTRL+C to stop.")
     
     try:
-        # Keep the script alive
+        # Keep the script alive. All the work happens in other threads, so the main
+        # thread only has to wait for CTRL+C. time.sleep (unlike Event.wait or
+        # Thread.join) is interrupted by CTRL+C right away on Windows, so a long
+        # sleep costs one wake-up an hour instead of one every second.
         while True:
-            time.sleep(1)
+            time.sleep(3600)
     except KeyboardInterrupt:
-        # Handle graceful shutdown
+        # Handle graceful shutdown (the Whisper server is stopped at exit)
         observer_sentry.stop()
     
     observer_sentry.join()
\ No newline at end of file